@@ -7,9 +7,10 @@ from contextlib import asynccontextmanager
 import json
 import logging
 import os
+import sys
 import time
-from tkinter import messagebox
 from typing import Optional, Tuple, Type, Union
+import uuid
 
 import aiofiles
 import aiofiles.os
@@ -19,11 +20,25 @@ import anyio.abc
 from async_timeout import timeout
 import configargparse
 
+from capture import capture_connection
+from capture import CaptureWriter
+from capture import replay_connection
 from consts import CONNECT_TIMEOUT
 from consts import IDLE_TIMEOUT
+from consts import MAX_LINE_LENGTH
 from consts import READ_TIMEOUT
-import gui
-from reader import make_timestamp
+import events
+from framing import LineFramer
+from framing import OVERSIZED_MODES
+from history import ChatMessage
+from history import format_message
+from history import HISTORY_FORMATS
+from history import HistoryMessage
+from history import HistoryWriter
+from history import parse_history_line
+from loop_profiler import Profiler
+from probe import LatencyProbe
+from probe import run_probe
 import utils
 from utils import Backoff
 from writer import send_message
@@ -35,38 +50,89 @@ watchdog_logger = logging.getLogger('watchdog')
 async def read_msgs(host: str, port: int,
                     status_updates_queue: asyncio.Queue,
                     watchdog_queue: asyncio.Queue,
-                    *out_queues: asyncio.Queue):
-    """Connect to chat server, read and save all messages to history_file and queue."""
+                    *out_queues: asyncio.Queue,
+                    probe: Optional[LatencyProbe] = None,
+                    open_connection=asyncio.open_connection,
+                    framer: Optional[LineFramer] = None,
+                    read_timeout: Optional[float] = READ_TIMEOUT) -> int:
+    """Connect to chat server, read messages and put them to out_queues as ChatMessage.
+
+    Probe messages are accounted by probe and skipped if probe.suppress is set.
+    open_connection can be replaced, e.g. with capture.capture_connection or capture.replay_connection.
+    Lines are framed and decoded by framer, so bad lines do not break connection.
+    read_timeout None disables timeout (e.g. for replay keeping long pauses of original stream).
+    Return number of read messages when server closes connection.
+    """
+    server = f'{host}:{port}'
+    messages_count = 0
+    if framer is None:
+        framer = LineFramer()
     async with open_connection_with_status(
             host, port,
             status_updates_queue=status_updates_queue,
-            connection_status_enum=gui.ReadConnectionStateChanged
+            connection_status_enum=events.ReadConnectionStateChanged,
+            open_connection=open_connection,
+            limit=framer.max_line_length,
     ) as (reader, writer):
+        connection_id = uuid.uuid4().hex
 
         while not reader.at_eof():
-            async with timeout(READ_TIMEOUT):
-                line = await reader.readline()
+            async with timeout(read_timeout):
+                line = await framer.readline(reader)
+            if not line:
+                break
 
-            message = line.decode().rstrip()
+            messages_count += 1
+            message = ChatMessage.received(framer.decode(line).rstrip(), server, connection_id)
 
             watchdog_queue.put_nowait('New message in chat')
 
+            if probe is not None and probe.observe(message) and probe.suppress:
+                continue
+
             for queue in out_queues:
                 queue.put_nowait(message)
                 queue.task_done()
 
+    return messages_count
+
+
+async def replay_msgs(capture_path: str, speed: float,
+                      status_updates_queue: asyncio.Queue,
+                      *out_queues: asyncio.Queue,
+                      framer: Optional[LineFramer] = None) -> int:
+    """Replay capture file once through read_msgs to out_queues, return number of replayed messages.
+
+    Replay has no read timeout and no watchdog, pauses of original stream are kept as is.
+    """
+    return await read_msgs('replay', 0, status_updates_queue, asyncio.Queue(), *out_queues,
+                           open_connection=replay_connection(capture_path, speed),
+                           framer=framer,
+                           read_timeout=None)
+
 
-async def save_messages(filepath: str, queue: asyncio.Queue):
-    """Save messages from queue to file filepath."""
-    async with aiofiles.open(filepath, mode='a') as chat_log_file:
+async def wait_queue_empty(queue: asyncio.Queue, interval=0.01):
+    """Wait until queue consumer takes all messages."""
+    while not queue.empty():
+        await asyncio.sleep(interval)
+
+
+async def save_messages(filepath: str, queue: asyncio.Queue, history_format='text', max_batch=1000):
+    """Save messages from queue to file filepath in history_format.
+
+    Messages waiting in queue are appended in batches (up to max_batch) with single atomic write.
+    """
+    with HistoryWriter(filepath) as history_writer:
         while True:
-            message = await queue.get()
+            messages = [await queue.get()]
+            while not queue.empty() and len(messages) < max_batch:
+                messages.append(queue.get_nowait())
 
-            formated_line = f'[{make_timestamp()}] {message}\n'
-            logger.debug(repr(formated_line))
+            formated_lines = [format_message(message, history_format) for message in messages]
+            for formated_line in formated_lines:
+                logger.debug(repr(formated_line))
 
-            await chat_log_file.write(formated_line)
-            await chat_log_file.flush()
+            await history_writer.write(formated_lines)
 
 
 async def authorize_writer(token, reader, writer, status_updates_queue, watchdog_queue):
@@ -105,12 +171,12 @@ async def authorize_writer(token, reader, writer, status_updates_queue, watchdog
     if login_response:
         nickname = login_response.get('nickname')
         logger.debug('Выполнена авторизация. Пользователь %r.', nickname)
-        status_updates_queue.put_nowait(gui.NicknameReceived(nickname))
+        status_updates_queue.put_nowait(events.NicknameReceived(nickname))
         watchdog_queue.put_nowait('Authorization done')
 
 
-ConnectionStatusEnum = Union[Type[gui.ReadConnectionStateChanged],
-                             Type[gui.SendingConnectionStateChanged]]
+ConnectionStatusEnum = Union[Type[events.ReadConnectionStateChanged],
+                             Type[events.SendingConnectionStateChanged]]
 
 
 @asynccontextmanager
@@ -119,6 +185,8 @@ async def open_connection_with_status(
         status_updates_queue: asyncio.Queue,
         connection_status_enum: ConnectionStatusEnum,
         connect_timeout=CONNECT_TIMEOUT,
+        open_connection=asyncio.open_connection,
+        limit=MAX_LINE_LENGTH,
 ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
     """
     Make connection and close it after __aexit__.
@@ -131,7 +199,7 @@ async def open_connection_with_status(
     try:
         async with timeout(connect_timeout):
             reader: asyncio.StreamReader
-            reader, writer = await asyncio.open_connection(host, port)
+            reader, writer = await open_connection(host, port, limit=limit)
 
         status_updates_queue.put_nowait(connection_status_enum.ESTABLISHED)
 
@@ -148,15 +216,17 @@ async def send_msgs(
         host: str, port: int, token: str,
         sending_queue: asyncio.Queue,
         status_updates_queue: asyncio.Queue,
-        watchdog_queue: asyncio.Queue):
+        watchdog_queue: asyncio.Queue,
+        probe: Optional[LatencyProbe] = None):
     """
     Establish connection to writing server and send messages from sending_queue.
 
     Send status updates to status_updates_queue and activity to watchdog_queue.
+    Probe (if any) is notified about actual send time of probe messages.
     """
     async with open_connection_with_status(
             host, port,
-            connection_status_enum=gui.SendingConnectionStateChanged,
+            connection_status_enum=events.SendingConnectionStateChanged,
             status_updates_queue=status_updates_queue,
     ) as (reader, writer):
 
@@ -166,7 +236,9 @@ async def send_msgs(
             try:
                 with timeout(IDLE_TIMEOUT) as timeout_context:
                     message = await sending_queue.get()
-                    logger.debug('Пользователь написал: %r', )
+                    logger.debug('Пользователь написал: %r', message)
+                    if probe is not None:
+                        probe.mark_sent(message)
                     await send_message(message, reader, writer)
                     watchdog_queue.put_nowait('Message sent')
 
@@ -178,7 +250,7 @@ async def send_msgs(
 
 
 async def load_history(filepath: str, queue: asyncio.Queue, tail_size=10240):
-    """Load tail of file filepath to queue."""
+    """Load tail (tail_size bytes) of file filepath to queue as HistoryMessage."""
     async with aiofiles.open(filepath, mode='r') as chat_log_file:
         file_size = (await aiofiles.os.stat(filepath)).st_size
         if file_size > tail_size:
@@ -196,7 +268,7 @@ async def load_history(filepath: str, queue: asyncio.Queue, tail_size=10240):
             # намеренно пропускаем первую строку
             # т.к. она, весьма вероятно, прочиталась не целиком
             message = await chat_log_file.readline()
-            await queue.put(message.rstrip())
+            await queue.put(HistoryMessage._make(parse_history_line(message.rstrip())))
 
 
 async def watch_for_connection(watchdog_queue):
@@ -225,29 +297,144 @@ async def handle_connection(*coroutines):
             tg.start_soon(coroutine)
 
 
+async def log_status_updates(status_updates_queue: asyncio.Queue):
+    """Log statuses from status_updates_queue instead of showing them in gui."""
+    while True:
+        status = await status_updates_queue.get()
+        if isinstance(status, events.NicknameReceived):
+            logger.info('Имя пользователя: %s', status.nickname)
+        else:
+            logger.info('%s: %s', type(status).__name__, status)
+
+
+async def queue_lines(reader: asyncio.StreamReader, sending_queue: asyncio.Queue):
+    """Put every non empty line from reader to sending_queue."""
+    while not reader.at_eof():
+        line = await reader.readline()
+        message = line.decode(errors='replace').rstrip('\r\n')
+        if message:
+            sending_queue.put_nowait(message)
+
+
+async def read_stdin_messages(sending_queue: asyncio.Queue):
+    """Read outbound messages from stdin line by line."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except ValueError:
+        # stdin перенаправлен из обычного файла, pipe transport его не поддерживает
+        async with aiofiles.open(sys.stdin.fileno(), mode='r', closefd=False) as stdin_file:
+            async for line in stdin_file:
+                message = line.rstrip('\r\n')
+                if message:
+                    sending_queue.put_nowait(message)
+        return
+
+    await queue_lines(reader, sending_queue)
+    logger.debug('stdin closed')
+
+
+async def serve_send_socket(path: str, sending_queue: asyncio.Queue):
+    """Accept outbound messages line by line from local unix socket path."""
+    async def handle_client(reader, writer):
+        try:
+            await queue_lines(reader, sending_queue)
+        finally:
+            writer.close()
+
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle_client, path)
+    async with server:
+        await server.serve_forever()
+
+
 async def main(options):
-    """Init and start gui application chat reader/writer."""
+    """Init and start gui or headless application chat reader/writer."""
     messages_queue = asyncio.Queue()
     messages_log_queue = asyncio.Queue()
     sending_queue = asyncio.Queue()
     status_updates_queue = asyncio.Queue()
     watchdog_queue = asyncio.Queue()
 
-    async with anyio.create_task_group() as tg:
-        tg.start_soon(gui.draw, messages_queue, sending_queue, status_updates_queue)
-        tg.start_soon(load_history, options.history, messages_queue)
-        tg.start_soon(save_messages, options.history, messages_log_queue)
-
-        tg.start_soon(
-            handle_connection,
-            lambda: read_msgs(options.read_host, options.read_port,
-                              status_updates_queue,
-                              watchdog_queue,
-                              messages_queue,
-                              messages_log_queue),
-            lambda: send_msgs(options.write_host, options.write_port, options.write_token,
-                              sending_queue, status_updates_queue, watchdog_queue),
-            lambda: watch_for_connection(watchdog_queue))
+    capture = CaptureWriter(options.capture) if options.capture else None
+    read_connection = capture_connection(capture) if capture is not None else asyncio.open_connection
+    framer = LineFramer(options.max_line_length, options.oversized_lines)
+
+    profiler = None
+    if options.profile:
+        profiler = Profiler(slow_callback_duration=options.profile_slow_callback, report_path=options.profile_report)
+        profiler.install(asyncio.get_running_loop())
+
+    probe = None
+    if options.probe_interval and not options.replay:
+        probe = LatencyProbe(loss_timeout=options.probe_loss_timeout, suppress=options.probe_suppress)
+
+    # воспроизведенные сообщения никогда не пишутся в живую историю, только в явно заданный --replay_history
+    history_path = None
+    if options.replay:
+        history_path = options.replay_history
+    elif not options.readonly_history:
+        history_path = options.history
+
+    async def replay_once():
+        replayed = await replay_msgs(options.replay, options.replay_speed, status_updates_queue, *out_queues,
+                                     framer=framer)
+        logger.info('Воспроизведено сообщений: %d', replayed)
+        if options.headless:
+            await wait_queue_empty(messages_log_queue)
+            tg.cancel_scope.cancel()
+
+    try:
+        async with anyio.create_task_group() as tg:
+            if options.headless:
+                out_queues = []
+                tg.start_soon(log_status_updates, status_updates_queue)
+                if options.send_socket and not options.replay:
+                    tg.start_soon(serve_send_socket, options.send_socket, sending_queue)
+                elif not options.replay:
+                    tg.start_soon(read_stdin_messages, sending_queue)
+            else:
+                # tkinter импортируется только для gui, чтобы headless режим запускался без дисплея и быстрее
+                import gui
+                out_queues = [messages_queue]
+                tg.start_soon(gui.draw, messages_queue, sending_queue, status_updates_queue)
+                if not options.replay:
+                    tg.start_soon(load_history, options.history, messages_queue, options.history_tail)
+
+            if history_path:
+                out_queues.append(messages_log_queue)
+                tg.start_soon(save_messages, history_path, messages_log_queue, options.history_format)
+            if probe is not None:
+                tg.start_soon(run_probe, probe, sending_queue, options.probe_interval)
+            if profiler is not None:
+                tg.start_soon(profiler.monitor_lag)
+
+            if options.replay:
+                # без переподключений, watchdog и сервера отправки: запись проигрывается один раз и офлайн
+                tg.start_soon(replay_once)
+                return
+
+            tg.start_soon(
+                handle_connection,
+                lambda: read_msgs(options.read_host, options.read_port,
+                                  status_updates_queue,
+                                  watchdog_queue,
+                                  *out_queues,
+                                  probe=probe,
+                                  open_connection=read_connection,
+                                  framer=framer),
+                lambda: send_msgs(options.write_host, options.write_port, options.write_token,
+                                  sending_queue, status_updates_queue, watchdog_queue,
+                                  probe=probe),
+                lambda: watch_for_connection(watchdog_queue))
+    finally:
+        if capture is not None:
+            capture.close()
+        if profiler is not None:
+            profiler.dump()
+            profiler.uninstall(asyncio.get_running_loop())
 
 
 if __name__ == '__main__':
@@ -262,18 +449,53 @@ if __name__ == '__main__':
     args.add('--write_host', env_var='WRITE_HOST', help='host of server to write')
     args.add('--write_port', env_var='WRITE_PORT', help='port of server to write')
     args.add('--write_token', env_var='TOKEN', help='port of server')
+    args.add('--readonly_history', action='store_true', env_var='READONLY_HISTORY',
+             help='do not write history file (e.g. when it is written by relay.py)')
+    args.add('--history_tail', type=int, default=10240, env_var='HISTORY_TAIL',
+             help='bytes of history file tail to load into gui')
+    args.add('--headless', action='store_true', env_var='HEADLESS',
+             help='run without gui, messages to send are read from stdin or --send_socket')
+    args.add('--send_socket', env_var='SEND_SOCKET', help='unix socket path to read messages to send (headless)')
+    args.add('--probe_interval', type=float, env_var='PROBE_INTERVAL',
+             help='send latency probe message every N seconds (disabled by default)')
+    args.add('--probe_loss_timeout', type=float, default=30, env_var='PROBE_LOSS_TIMEOUT',
+             help='seconds after which probe message is considered lost')
+    args.add('--probe_suppress', action='store_true', env_var='PROBE_SUPPRESS',
+             help='do not show and save probe messages')
+    args.add('--max_line_length', type=int, default=MAX_LINE_LENGTH, env_var='MAX_LINE_LENGTH',
+             help='max length of chat line in bytes')
+    args.add('--oversized_lines', choices=OVERSIZED_MODES, default='truncate', env_var='OVERSIZED_LINES',
+             help='truncate oversized lines or deliver them in chunks')
+    args.add('--capture', env_var='CAPTURE_FILE', help='record raw read stream to capture file')
+    args.add('--replay', help='replay capture file instead of reading from server')
+    args.add('--replay_speed', type=float, default=1.0,
+             help='replay speed multiplier, 0 - as fast as possible')
+    args.add('--replay_history', help='history file to save replayed messages to (not saved by default)')
+    args.add('--profile', action='store_true', env_var='PROFILE',
+             help='measure loop lag, report slow callbacks and tasks cpu time (report on exit and SIGUSR1)')
+    args.add('--profile_report', env_var='PROFILE_REPORT', help='file to write profile report to (json)')
+    args.add('--profile_slow_callback', type=float, default=0.1,
+             help='report callbacks running longer than N seconds')
     args.add('--loglevel', help='log level')
     args.add('--history', env_var='HISTORY_FILE', help='history file path')
+    args.add('--history_format', env_var='HISTORY_FORMAT', choices=HISTORY_FORMATS, default='text',
+             help='history file format')
     options = args.parse_args()
 
     if options.loglevel:
         logging.basicConfig(level=options.loglevel)
         logger.setLevel(options.loglevel)
         watchdog_logger.setLevel(options.loglevel)
-    loop = asyncio.get_event_loop()
+    elif options.headless:
+        logging.basicConfig(level=logging.INFO)
 
-    with contextlib.suppress(gui.TkAppClosed, KeyboardInterrupt):
+    utils.interrupt_on_sigterm()
+    with contextlib.suppress(events.TkAppClosed, KeyboardInterrupt):
         try:
             asyncio.run(main(options))
         except utils.WrongToken:
+            if options.headless:
+                logger.error('Неверный токен. Проверьте токен, сервер его не узнал.')
+                sys.exit(1)
+            from tkinter import messagebox
             messagebox.showerror('Неверный токен', 'Проверьте токен, сервер его не узнал.')
@@ -0,0 +1,157 @@
+"""Record and replay of raw chat stream module.
+
+Capture file is magic header followed by records:
+little endian uint64 arrival time (ns since capture start), uint32 length and raw bytes.
+"""
+
+import asyncio
+import contextlib
+import logging
+import struct
+import time
+from typing import Iterator, Optional, Tuple
+
+CAPTURE_MAGIC = b'CHATCAP1'
+RECORD_HEADER = struct.Struct('<QI')
+
+logger = logging.getLogger('capture')
+
+
+class CaptureError(Exception):
+    """Exception for broken capture files."""
+
+
+class CaptureWriter:
+    """Write raw chunks of chat stream with arrival times to capture file.
+
+    File is flushed at most every flush_interval seconds (on write), so killed process loses only the tail.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        """Create (truncate) capture file path."""
+        # обычный буферизованный файл: запись пары сотен байт в буфер дешевле, чем переход в поток aiofiles
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._start_ns = time.monotonic_ns()
+        self._flushed_ns = self._start_ns
+        self._flush_interval_ns = int(flush_interval * 1_000_000_000)
+        self.records = 0
+
+    def write(self, data: bytes, monotonic_ns: Optional[int] = None):
+        """Append data received at monotonic_ns (now by default)."""
+        if monotonic_ns is None:
+            monotonic_ns = time.monotonic_ns()
+        self._file.write(RECORD_HEADER.pack(max(0, monotonic_ns - self._start_ns), len(data)))
+        self._file.write(data)
+        self.records += 1
+        if monotonic_ns - self._flushed_ns >= self._flush_interval_ns:
+            self._file.flush()
+            self._flushed_ns = monotonic_ns
+
+    def close(self):
+        """Flush and close capture file."""
+        self._file.close()
+
+    def __enter__(self):
+        """Return self for usage as context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close capture file."""
+        self.close()
+
+
+def iter_capture(path: str) -> Iterator[Tuple[int, bytes]]:
+    """Iterate over (arrival ns since capture start, raw bytes) records of capture file path.
+
+    Truncated last record (capture of killed process) is skipped with warning.
+    """
+    with open(path, 'rb') as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise CaptureError(f'{path!r} is not a capture file')
+        while True:
+            header = capture_file.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                logger.warning('truncated record header at the end of %r skipped', path)
+                return
+            offset_ns, length = RECORD_HEADER.unpack(header)
+            data = capture_file.read(length)
+            if len(data) < length:
+                logger.warning('truncated record at the end of %r skipped (%d of %d bytes)', path, len(data), length)
+                return
+            yield offset_ns, data
+
+
+async def feed_capture(path: str, reader: asyncio.StreamReader, speed: float = 1.0):
+    """Feed capture records to reader keeping original timing divided by speed.
+
+    Speed 0 means as fast as possible.
+    """
+    start = time.monotonic()
+    try:
+        for offset_ns, data in iter_capture(path):
+            if speed:
+                delay = start + offset_ns / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            reader.feed_data(data)
+            if not speed:
+                # отдаем управление, чтобы читатель разбирал поток, а не копил его в буфере
+                await asyncio.sleep(0)
+    finally:
+        reader.feed_eof()
+
+
+class RecordingStreamReader(asyncio.StreamReader):
+    """StreamReader which records every chunk fed by transport to capture when it arrives."""
+
+    def __init__(self, capture: CaptureWriter, **reader_kwargs):
+        """Store capture to record chunks to."""
+        super().__init__(**reader_kwargs)
+        self._capture = capture
+
+    def feed_data(self, data: bytes):
+        """Record chunk with its arrival time and pass it to reader buffer."""
+        self._capture.write(data)
+        super().feed_data(data)
+
+
+def capture_connection(capture: CaptureWriter):
+    """Make asyncio.open_connection replacement which records received stream to capture."""
+    async def open_recorded(host, port, **reader_kwargs):
+        loop = asyncio.get_running_loop()
+        reader = RecordingStreamReader(capture, **reader_kwargs)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.create_connection(lambda: protocol, host, port)
+        return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    return open_recorded
+
+
+class ReplayWriter:
+    """Writer stub of replay connection, stops feeding on close."""
+
+    def __init__(self, feeder: asyncio.Task):
+        """Store feeder task."""
+        self._feeder = feeder
+
+    def close(self):
+        """Stop feeding capture."""
+        self._feeder.cancel()
+
+    async def wait_closed(self):
+        """Wait for feeder to stop."""
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._feeder
+
+
+def replay_connection(path: str, speed: float = 1.0):
+    """Make asyncio.open_connection replacement which replays capture path instead of connecting."""
+    async def open_replay(host=None, port=None, **reader_kwargs):
+        reader = asyncio.StreamReader(**reader_kwargs)
+        feeder = asyncio.ensure_future(feed_capture(path, reader, speed))
+        return reader, ReplayWriter(feeder)
+
+    return open_replay
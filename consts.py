@@ -1,3 +1,4 @@
 CONNECT_TIMEOUT = 3
 READ_TIMEOUT = 3
 IDLE_TIMEOUT = 3
+MAX_LINE_LENGTH = 64 * 1024
@@ -0,0 +1,155 @@
+"""Bulk convert legacy chat.log files to indexed JSONL segments."""
+
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import json
+import logging
+import os
+from typing import List, NamedTuple
+
+import configargparse
+
+from history import format_jsonl
+from history import parse_history_line
+
+logger = logging.getLogger('convert')
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+INDEX_FILE_NAME = 'index.json'
+
+
+class Chunk(NamedTuple):
+    """Part of source file between line boundaries."""
+
+    source: str
+    start: int
+    end: int
+    segment: str
+
+
+def split_file(path: str, chunk_size: int) -> List[tuple]:
+    """Split file path to (start, end) byte ranges of about chunk_size, ending at line boundaries."""
+    file_size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as source_file:
+        start = 0
+        while start < file_size:
+            source_file.seek(min(start + chunk_size, file_size))
+            source_file.readline()
+            end = min(source_file.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def decode_lines(data: bytes):
+    """Decode data to lines replacing invalid bytes, return lines and count of broken lines.
+
+    Lines are split on newline byte only (as history is written), trailing CR of CRLF is dropped.
+    str.splitlines() is not used: it would also split messages on U+2028, form feed and similar characters.
+    """
+    lines = []
+    decode_errors = 0
+    for raw_line in data.split(b'\n'):
+        raw_line = raw_line.rstrip(b'\r')
+        try:
+            lines.append(raw_line.decode())
+        except UnicodeDecodeError:
+            decode_errors += 1
+            lines.append(raw_line.decode(errors='replace'))
+    return lines, decode_errors
+
+
+def convert_chunk(chunk: Chunk):
+    """Parse chunk of source file and write it as JSONL segment (gzipped if segment ends with .gz).
+
+    Return segment index entry.
+    """
+    with open(chunk.source, 'rb') as source_file:
+        source_file.seek(chunk.start)
+        data = source_file.read(chunk.end - chunk.start)
+
+    lines, decode_errors = decode_lines(data)
+
+    messages = 0
+    unparsed = 0
+    first_wall_ns = last_wall_ns = None
+    open_segment = gzip.open if chunk.segment.endswith('.gz') else open
+    with open_segment(chunk.segment, 'wt', encoding='utf-8') as segment_file:
+        for line in lines:
+            if not line:
+                continue
+            message = parse_history_line(line)
+            if message.wall_ns is None:
+                unparsed += 1
+            else:
+                if first_wall_ns is None:
+                    first_wall_ns = message.wall_ns
+                last_wall_ns = message.wall_ns
+            segment_file.write(format_jsonl(message))
+            messages += 1
+
+    return {
+        'segment': os.path.basename(chunk.segment),
+        'source': chunk.source,
+        'start': chunk.start,
+        'end': chunk.end,
+        'messages': messages,
+        'decode_errors': decode_errors,
+        'unparsed': unparsed,
+        'first_wall_ns': first_wall_ns,
+        'last_wall_ns': last_wall_ns,
+    }
+
+
+def make_chunks(paths: List[str], output_dir: str, chunk_size: int, compress=False) -> List[Chunk]:
+    """Split all files in paths to chunks with segment file names in output_dir."""
+    extension = '.jsonl.gz' if compress else '.jsonl'
+    chunks = []
+    for path in paths:
+        for start, end in split_file(path, chunk_size):
+            segment = os.path.join(output_dir, f'{len(chunks):06d}{extension}')
+            chunks.append(Chunk(path, start, end, segment))
+    return chunks
+
+
+def convert(paths: List[str], output_dir: str, chunk_size=DEFAULT_CHUNK_SIZE, compress=False, workers=None):
+    """Convert history files to JSONL segments in output_dir in parallel and write segments index."""
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = make_chunks(paths, output_dir, chunk_size, compress)
+    logger.debug('%d files split to %d chunks', len(paths), len(chunks))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        index = list(executor.map(convert_chunk, chunks))
+
+    with open(os.path.join(output_dir, INDEX_FILE_NAME), 'w', encoding='utf-8') as index_file:
+        json.dump(index, index_file, ensure_ascii=False, indent=1)
+
+    return index
+
+
+def main():
+    """Parse args and run conversion."""
+    args = configargparse.ArgParser(prog='convert_history.py')
+    args.add('-c', '--config', is_config_file=True, help='config file path')
+    args.add('--output', required=True, help='directory for segments and index')
+    args.add('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE, help='approximate chunk size in bytes')
+    args.add('--workers', type=int, help='number of worker processes (default: number of cpus)')
+    args.add('--compress', action='store_true', help='gzip segments')
+    args.add('--loglevel', help='log level')
+    args.add('files', nargs='+', help='history files to convert')
+    options = args.parse_args()
+
+    if options.loglevel:
+        logging.basicConfig(level=options.loglevel)
+        logger.setLevel(options.loglevel)
+
+    index = convert(options.files, options.output, options.chunk_size, options.compress, options.workers)
+    logger.debug('converted %d messages, %d decode errors, %d unparsed lines',
+                 sum(entry['messages'] for entry in index),
+                 sum(entry['decode_errors'] for entry in index),
+                 sum(entry['unparsed'] for entry in index))
+
+
+if __name__ == '__main__':
+    main()
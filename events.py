@@ -0,0 +1,42 @@
+"""Application events shared by gui and headless modes.
+
+Module must not import tkinter, so headless application can use it without display.
+"""
+
+from enum import Enum
+
+
+class TkAppClosed(Exception):
+    """Exception raised when gui window has been closed."""
+
+
+class ReadConnectionStateChanged(Enum):
+    """Read connection status."""
+
+    INITIATED = 'устанавливаем соединение'
+    ESTABLISHED = 'соединение установлено'
+    CLOSED = 'соединение закрыто'
+
+    def __str__(self):
+        """Return human readable status."""
+        return str(self.value)
+
+
+class SendingConnectionStateChanged(Enum):
+    """Sending connection status."""
+
+    INITIATED = 'устанавливаем соединение'
+    ESTABLISHED = 'соединение установлено'
+    CLOSED = 'соединение закрыто'
+
+    def __str__(self):
+        """Return human readable status."""
+        return str(self.value)
+
+
+class NicknameReceived:
+    """Nickname of authorized user."""
+
+    def __init__(self, nickname):
+        """Store nickname."""
+        self.nickname = nickname
@@ -0,0 +1,99 @@
+"""Line framing of chat stream module.
+
+Protects reading loops from oversized lines and invalid utf-8,
+so a single bad message does not break the connection.
+"""
+
+import asyncio
+import logging
+import weakref
+
+from consts import MAX_LINE_LENGTH
+
+logger = logging.getLogger('framing')
+
+OVERSIZED_MODES = ('truncate', 'chunk')
+SEPARATOR = b'\n'
+
+
+def complete_utf8_length(data: bytes) -> int:
+    """Return length of data without incomplete utf-8 character at its end."""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            # байт продолжения, ищем начало символа дальше
+            continue
+        if byte >= 0xF0:
+            size = 4
+        elif byte >= 0xE0:
+            size = 3
+        elif byte >= 0xC0:
+            size = 2
+        else:
+            size = 1
+        return len(data) if back >= size else len(data) - back
+    return len(data)
+
+
+class LineFramer:
+    """Read lines not longer than max_line_length and decode them with replacement.
+
+    Oversized lines are truncated (the rest is skipped) or delivered in chunks,
+    both are cut at utf-8 character boundary.
+    Counters are shared by all connections read with the framer.
+    StreamReader must be created with limit=max_line_length.
+    """
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH, oversized='truncate'):
+        """Initiate framer settings and counters."""
+        if oversized not in OVERSIZED_MODES:
+            raise ValueError(f'unknown oversized lines mode {oversized!r}')
+        self.max_line_length = max_line_length
+        self.oversized = oversized
+        self.truncated = 0
+        self.chunks = 0
+        self.decode_errors = 0
+        # начало символа, разрезанного границей куска, по соединениям
+        self._carry = weakref.WeakKeyDictionary()
+
+    async def readline(self, reader: asyncio.StreamReader) -> bytes:
+        """Read line (or its part for oversized lines) from reader, return b'' on eof."""
+        carry = self._carry.pop(reader, b'')
+        try:
+            return carry + await reader.readuntil(SEPARATOR)
+        except asyncio.IncompleteReadError as ex:
+            return carry + ex.partial
+        except asyncio.LimitOverrunError:
+            head = carry + await reader.read(self.max_line_length - len(carry))
+
+        end = complete_utf8_length(head) or len(head)
+        if self.oversized == 'chunk':
+            self.chunks += 1
+            if end < len(head):
+                self._carry[reader] = head[end:]
+            return head[:end]
+
+        self.truncated += 1
+        logger.warning('line longer than %d bytes truncated (%d total)', self.max_line_length, self.truncated)
+        await self._skip_line(reader)
+        return head[:end]
+
+    async def _skip_line(self, reader: asyncio.StreamReader):
+        """Skip rest of oversized line."""
+        while True:
+            try:
+                await reader.readuntil(SEPARATOR)
+                return
+            except asyncio.IncompleteReadError:
+                return
+            except asyncio.LimitOverrunError:
+                await reader.read(self.max_line_length)
+
+    def decode(self, line: bytes) -> str:
+        """Decode line as utf-8 replacing invalid bytes."""
+        try:
+            return line.decode()
+        except UnicodeDecodeError:
+            self.decode_errors += 1
+            logger.warning('invalid utf-8 in line %r (%d total)', line[:100], self.decode_errors)
+            return line.decode(errors='replace')
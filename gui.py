@@ -1,36 +1,21 @@
 import asyncio
-from enum import Enum
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 
 import anyio
 
+from events import NicknameReceived
+from events import ReadConnectionStateChanged
+from events import SendingConnectionStateChanged
+from events import TkAppClosed
+from history import ChatMessage
+from history import HistoryMessage
+from history import render_message
+from message_store import MessageFilter
+from message_store import MessageStore
+from message_store import parse_filter
 
-class TkAppClosed(Exception):
-    pass
-
-
-class ReadConnectionStateChanged(Enum):
-    INITIATED = 'устанавливаем соединение'
-    ESTABLISHED = 'соединение установлено'
-    CLOSED = 'соединение закрыто'
-
-    def __str__(self):
-        return str(self.value)
-
-
-class SendingConnectionStateChanged(Enum):
-    INITIATED = 'устанавливаем соединение'
-    ESTABLISHED = 'соединение установлено'
-    CLOSED = 'соединение закрыто'
-
-    def __str__(self):
-        return str(self.value)
-
-
-class NicknameReceived:
-    def __init__(self, nickname):
-        self.nickname = nickname
+FILTER_WINDOW = 2000
 
 
 def process_new_message(input_field, sending_queue):
@@ -49,9 +34,41 @@ async def update_tk(root_frame, interval=1 / 120):
         await asyncio.sleep(interval)
 
 
-async def update_conversation_history(panel, messages_queue):
+def render_stored_message(message_store, index):
+    text, wall_ns, stamped = message_store.get(index)
+    return render_message(ChatMessage(text, wall_ns=wall_ns)) if stamped else text
+
+
+def render_conversation(panel, message_store, message_filter, window=FILTER_WINDOW):
+    indexes = message_store.search(message_filter, window)
+
+    panel['state'] = 'normal'
+    panel.delete('1.0', tk.END)
+    panel.insert('end', '\n'.join(render_stored_message(message_store, index) for index in indexes))
+    panel.yview('1.0' if message_filter.since is not None else tk.END)
+    panel['state'] = 'disabled'
+
+
+def apply_filter(panel, message_store, view, search_field, since_field):
+    message_filter = parse_filter(search_field.get(), since_field.get())
+    if message_filter == view['filter']:
+        return
+    view['filter'] = message_filter
+    render_conversation(panel, message_store, message_filter)
+
+
+async def update_conversation_history(panel, messages_queue, message_store, view):
     while True:
         msg = await messages_queue.get()
+        if not isinstance(msg, ChatMessage):
+            msg = ChatMessage(str(msg))
+
+        # время показываем только у сообщений из файла истории
+        stamped = isinstance(msg, HistoryMessage)
+        index = message_store.append(msg.text, msg.wall_ns, stamped)
+
+        if not message_store.matches(index, view['filter']):
+            continue
 
         panel['state'] = 'normal'
 
@@ -60,7 +77,7 @@ async def update_conversation_history(panel, messages_queue):
 
         if panel.index('end-1c') != '1.0':
             panel.insert('end', '\n')
-        panel.insert('end', msg)
+        panel.insert('end', render_message(msg) if stamped else msg.text)
 
         if scroll_to_end:
             panel.yview(tk.END)
@@ -105,7 +122,30 @@ def create_status_panel(root_frame):
     return (nickname_label, status_read_label, status_write_label)
 
 
-async def draw(messages_queue, sending_queue, status_updates_queue):
+def create_filter_panel(root_frame):
+    filter_frame = tk.Frame(root_frame)
+    filter_frame.pack(side="top", fill=tk.X)
+
+    search_label = tk.Label(filter_frame, text='Поиск (@ник слово):', fg='grey', font='arial 10')
+    search_label.pack(side="left")
+
+    search_field = tk.Entry(filter_frame)
+    search_field.pack(side="left", fill=tk.X, expand=True)
+
+    since_label = tk.Label(filter_frame, text='с (ЧЧ:ММ):', fg='grey', font='arial 10')
+    since_label.pack(side="left")
+
+    since_field = tk.Entry(filter_frame, width=16)
+    since_field.pack(side="left")
+
+    return search_field, since_field
+
+
+async def draw(messages_queue, sending_queue, status_updates_queue, message_store=None):
+    if message_store is None:
+        message_store = MessageStore()
+    view = {'filter': MessageFilter()}
+
     root = tk.Tk()
 
     root.title('Чат Майнкрафтера')
@@ -114,6 +154,7 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
     root_frame.pack(fill="both", expand=True)
 
     status_labels = create_status_panel(root_frame)
+    search_field, since_field = create_filter_panel(root_frame)
 
     input_frame = tk.Frame(root_frame)
     input_frame.pack(side="bottom", fill=tk.X)
@@ -131,7 +172,12 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
     conversation_panel = ScrolledText(root_frame, wrap='none')
     conversation_panel.pack(side="top", fill="both", expand=True)
 
+    for filter_field in (search_field, since_field):
+        filter_field.bind(
+            "<KeyRelease>",
+            lambda event: apply_filter(conversation_panel, message_store, view, search_field, since_field))
+
     async with anyio.create_task_group() as tg:
         tg.start_soon(update_tk, root_frame)
-        tg.start_soon(update_conversation_history, conversation_panel, messages_queue)
+        tg.start_soon(update_conversation_history, conversation_panel, messages_queue, message_store, view)
         tg.start_soon(update_status_panel, status_labels, status_updates_queue)
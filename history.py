@@ -0,0 +1,173 @@
+"""Chat history records and formats module."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
+import json
+import os
+import re
+import time
+from typing import Iterable, NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+HISTORY_FORMATS = ('text', 'jsonl')
+
+TIMESTAMP_FORMAT = '%Y.%m.%d %H:%M'
+TEXT_LINE_RE = re.compile(r'^\[(\d{4}\.\d{2}\.\d{2} \d{2}:\d{2})\] ?(.*)$', re.DOTALL)
+
+_timestamp_cache = [None, '']
+
+
+class ChatMessage(NamedTuple):
+    """Chat message with receive times and source."""
+
+    text: str
+    monotonic_ns: Optional[int] = None
+    wall_ns: Optional[int] = None
+    server: str = ''
+    connection_id: str = ''
+
+    def __str__(self):
+        """Return message text, so message can be rendered as plain string."""
+        return self.text
+
+    @classmethod
+    def received(cls, text, server='', connection_id=''):
+        """Make message stamped with current monotonic and wall clock time."""
+        return cls(text, time.monotonic_ns(), time.time_ns(), server, connection_id)
+
+
+class HistoryMessage(ChatMessage):
+    """Chat message loaded from history file, it is shown with its timestamp."""
+
+    __slots__ = ()
+
+
+def make_timestamp(wall_time=None):
+    """Make formatted current (or wall_time) time string.
+
+    Formatted string is cached per second, so strftime is not called for every message.
+    """
+    if wall_time is None:
+        wall_time = time.time()
+    second = int(wall_time)
+    if _timestamp_cache[0] != second:
+        _timestamp_cache[0] = second
+        _timestamp_cache[1] = datetime.datetime.fromtimestamp(second).strftime(TIMESTAMP_FORMAT)
+    return _timestamp_cache[1]
+
+
+def format_text(message: ChatMessage):
+    """Format message as legacy `[YYYY.MM.DD HH:MM] text` line."""
+    wall_time = message.wall_ns / 1e9 if message.wall_ns is not None else None
+    return f'[{make_timestamp(wall_time)}] {message.text}\n'
+
+
+def format_jsonl(message: ChatMessage):
+    """Format message as one line JSON object."""
+    return json.dumps(message._asdict(), ensure_ascii=False) + '\n'
+
+
+FORMATTERS = {
+    'text': format_text,
+    'jsonl': format_jsonl,
+}
+
+
+def format_message(message: ChatMessage, history_format='text'):
+    """Format message as history line in history_format."""
+    return FORMATTERS[history_format](message)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_text_timestamp(timestamp):
+    """Convert `YYYY.MM.DD HH:MM` string to wall clock time in ns.
+
+    Result is cached, because neighbouring lines usually share the same minute.
+    """
+    parsed = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    return int(parsed.timestamp()) * 1_000_000_000
+
+
+def parse_history_line(line: str) -> ChatMessage:
+    """Parse history line of any supported format to ChatMessage."""
+    line = line.rstrip('\n')
+    if line.startswith('{'):
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            fields = None
+        if isinstance(fields, dict) and isinstance(fields.get('text'), str):
+            return ChatMessage(**{field: fields[field] for field in ChatMessage._fields if field in fields})
+
+    match = TEXT_LINE_RE.match(line)
+    if match:
+        try:
+            return ChatMessage(match.group(2), wall_ns=parse_text_timestamp(match.group(1)))
+        except ValueError:
+            pass
+    return ChatMessage(line)
+
+
+def render_message(message: ChatMessage):
+    """Render message as it is shown in chat window: with timestamp if it is known."""
+    if message.wall_ns is None:
+        return message.text
+    return format_text(message).rstrip('\n')
+
+
+class HistoryWriter:
+    """Append whole lines to history file shared by several processes.
+
+    Every batch of lines is written with a single write to file opened with O_APPEND
+    under exclusive advisory lock (where available), so lines of cooperating
+    processes never interleave or tear.
+    Writes and close run in one own thread in order, so file is closed only after pending writes.
+    """
+
+    def __init__(self, path: str):
+        """Open (create) history file path for appending."""
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+
+    def append(self, lines: Iterable[str]):
+        """Append lines (each ending with newline) atomically."""
+        data = ''.join(lines).encode()
+        if not data:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(self._fd, view)
+                view = view[written:]
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    async def write(self, lines: Iterable[str]):
+        """Append lines atomically without blocking event loop.
+
+        Lines are written even if caller is cancelled meanwhile.
+        """
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self.append, list(lines))
+        await asyncio.shield(future)
+
+    def close(self):
+        """Close history file after pending writes."""
+        self._executor.submit(os.close, self._fd)
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        """Return self for usage as context manager."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close history file after pending writes."""
+        self.close()
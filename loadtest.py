@@ -0,0 +1,254 @@
+"""Chat server load generator module.
+
+Simulates many concurrent readers and writers on one event loop or across processes.
+"""
+
+import asyncio
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import random
+import time
+
+import anyio
+import configargparse
+
+from register import connect_and_register
+from utils import open_connection
+from utils import percentile
+from utils import ProtocolError
+from writer import login
+from writer import send_message
+
+logger = logging.getLogger('loadtest')
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+LOAD_ERRORS = (OSError, EOFError, asyncio.TimeoutError, ProtocolError, ValueError)
+
+
+class ServerClosedConnection(ConnectionError):
+    """Exception for connection closed by server."""
+
+
+class LoadStats:
+    """Counters and latency samples of load run."""
+
+    def __init__(self):
+        """Initiate empty stats."""
+        self.counters = Counter()
+        self.errors = Counter()
+        self.send_latencies = []
+        self.connect_latencies = []
+        self.load_time = 0.0
+
+    def add_error(self, ex):
+        """Account exception ex."""
+        self.errors[type(ex).__name__] += 1
+
+    def to_dict(self):
+        """Convert stats to picklable dict."""
+        return {
+            'counters': dict(self.counters),
+            'errors': dict(self.errors),
+            'send_latencies': self.send_latencies,
+            'connect_latencies': self.connect_latencies,
+            'load_time': self.load_time,
+        }
+
+    @classmethod
+    def merge(cls, stats_dicts):
+        """Make stats from several to_dict() results."""
+        merged = cls()
+        for stats in stats_dicts:
+            merged.counters.update(stats['counters'])
+            merged.errors.update(stats['errors'])
+            merged.send_latencies.extend(stats['send_latencies'])
+            merged.connect_latencies.extend(stats['connect_latencies'])
+            # процессы нагружают сервер одновременно, поэтому окно нагрузки - самое длинное из них
+            merged.load_time = max(merged.load_time, stats['load_time'])
+        return merged
+
+    def report(self):
+        """Make report with throughput over load window, latency percentiles (seconds) and error rates."""
+        duration = self.load_time
+        report = dict(self.counters)
+        report['duration'] = duration
+        report['sent_per_second'] = self.counters['sent'] / duration if duration else None
+        report['received_per_second'] = self.counters['received'] / duration if duration else None
+        attempts = self.counters['connects'] + sum(self.errors.values())
+        report['error_rate'] = sum(self.errors.values()) / attempts if attempts else 0.0
+        report['errors'] = dict(self.errors)
+        for name, samples in (('send', self.send_latencies), ('connect', self.connect_latencies)):
+            samples = sorted(samples)
+            for fraction in (0.5, 0.9, 0.99):
+                report[f'{name}_p{int(fraction * 100)}'] = percentile(samples, fraction)
+        return report
+
+
+def timed_connection(host, port, stats: LoadStats):
+    """Open connection with utils.open_connection accounting connect latency."""
+    start = time.monotonic()
+
+    def on_connected():
+        stats.connect_latencies.append(time.monotonic() - start)
+        stats.counters['connects'] += 1
+
+    return open_connection(host, port, on_connected=on_connected)
+
+
+async def simulate_reader(host, port, stats: LoadStats, churn=None):
+    """Read chat forever, reconnecting every churn seconds."""
+    while True:
+        try:
+            async with timed_connection(host, port, stats) as (reader, _):
+                with anyio.move_on_after(churn or float('inf')):
+                    while not reader.at_eof():
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        stats.counters['received'] += 1
+                        stats.counters['received_bytes'] += len(line)
+                if reader.at_eof():
+                    raise ServerClosedConnection()
+        except LOAD_ERRORS as ex:
+            stats.add_error(ex)
+            await asyncio.sleep(1)
+
+
+async def simulate_writer(host, port, token, stats: LoadStats, send_rate=1.0, churn=None, user_id=0):
+    """Send messages with about send_rate per second forever, reconnecting every churn seconds."""
+    sequence = 0
+    while True:
+        try:
+            async with timed_connection(host, port, stats) as (reader, writer):
+                await login(token, reader, writer)
+                with anyio.move_on_after(churn or float('inf')):
+                    while True:
+                        await asyncio.sleep(random.expovariate(send_rate))
+                        sequence += 1
+                        start = time.monotonic()
+                        await send_message(f'loadtest {user_id}:{sequence}', reader, writer)
+                        stats.send_latencies.append(time.monotonic() - start)
+                        stats.counters['sent'] += 1
+        except LOAD_ERRORS as ex:
+            stats.add_error(ex)
+            await asyncio.sleep(1)
+
+
+async def register_users(host, port, count, stats: LoadStats, concurrency=50):
+    """Register count new users, at most concurrency at once, and return their tokens."""
+    tokens = []
+    limiter = anyio.CapacityLimiter(concurrency)
+
+    async def register_user():
+        async with limiter:
+            try:
+                tokens.append(await connect_and_register(host, port, f'loadtest-{random.getrandbits(32):08x}'))
+                stats.counters['registered'] += 1
+            except LOAD_ERRORS as ex:
+                stats.add_error(ex)
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(count):
+            tg.start_soon(register_user)
+    return tokens
+
+
+async def run_load(options, readers, writers, seed=None):
+    """Run readers and writers simulation for options.duration seconds, return stats dict."""
+    random.seed(seed)
+    stats = LoadStats()
+    tokens = list(options.tokens or [])
+    if writers and not tokens:
+        tokens = await register_users(options.write_host, options.write_port, options.register or writers, stats,
+                                      options.register_concurrency)
+    if writers and not tokens:
+        logger.error('no tokens for %d writers (registration errors: %s), load is not started',
+                     writers, dict(stats.errors))
+        return stats.to_dict()
+
+    load_start = time.monotonic()
+    async with anyio.create_task_group() as tg:
+        with anyio.move_on_after(options.duration):
+            ramp_delay = options.ramp_up / max(readers + writers, 1)
+            for _ in range(readers):
+                tg.start_soon(simulate_reader, options.read_host, options.read_port, stats, options.churn)
+                await asyncio.sleep(ramp_delay)
+            for user_id in range(writers):
+                tg.start_soon(simulate_writer, options.write_host, options.write_port,
+                              tokens[user_id % len(tokens)], stats, options.send_rate, options.churn, user_id)
+                await asyncio.sleep(ramp_delay)
+            await asyncio.sleep(float('inf'))
+        tg.cancel_scope.cancel()
+    stats.load_time = time.monotonic() - load_start
+
+    return stats.to_dict()
+
+
+def run_load_process(options, readers, writers, seed):
+    """Run load simulation in separate process."""
+    raise_open_files_limit()
+    return asyncio.run(run_load(options, readers, writers, seed))
+
+
+def raise_open_files_limit():
+    """Raise soft limit of open files to hard limit, every simulated user holds a socket."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def split_evenly(total, parts):
+    """Split total to parts integers which differ at most by one."""
+    return [total // parts + (1 if part < total % parts else 0) for part in range(parts)]
+
+
+def main():
+    """Parse args, run load and log report."""
+    args = configargparse.ArgParser(
+        prog='loadtest.py',
+        ignore_unknown_config_file_keys=True,
+        default_config_files=['.settings']
+    )
+    args.add('-c', '--config', is_config_file=True, help='config file path')
+    args.add('--read_host', env_var='READ_HOST', help='host of server to read')
+    args.add('--read_port', env_var='READ_PORT', help='port of server to read')
+    args.add('--write_host', env_var='WRITE_HOST', help='host of server to write')
+    args.add('--write_port', env_var='WRITE_PORT', help='port of server to write')
+    args.add('--tokens', nargs='*', help='tokens of writers (new users are registered if empty)')
+    args.add('--register', type=int, help='number of users to register when no tokens given (default: one per writer)')
+    args.add('--register_concurrency', type=int, default=50, help='number of users registered at once')
+    args.add('--readers', type=int, default=100, help='number of simulated readers')
+    args.add('--writers', type=int, default=10, help='number of simulated writers')
+    args.add('--send_rate', type=float, default=1.0, help='messages per second of each writer')
+    args.add('--churn', type=float, help='reconnect every N seconds (never by default)')
+    args.add('--ramp_up', type=float, default=0, help='seconds to start all simulated users')
+    args.add('--duration', type=float, default=60, help='load duration in seconds')
+    args.add('--processes', type=int, default=1, help='number of processes')
+    args.add('--loglevel', default='INFO', help='log level')
+    options = args.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+    logger.setLevel(options.loglevel)
+
+    readers = split_evenly(options.readers, options.processes)
+    writers = split_evenly(options.writers, options.processes)
+    if options.processes == 1:
+        results = [run_load_process(options, readers[0], writers[0], 0)]
+    else:
+        with ProcessPoolExecutor(max_workers=options.processes) as executor:
+            results = list(executor.map(run_load_process, [options] * options.processes,
+                                        readers, writers, range(options.processes)))
+
+    stats = LoadStats.merge(results)
+    logger.info('load report: %s', stats.report())
+
+
+if __name__ == '__main__':
+    main()
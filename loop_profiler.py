@@ -0,0 +1,157 @@
+"""Event loop lag monitor and per-task cpu profiling module."""
+
+import asyncio
+from collections import Counter
+from collections import deque
+import contextlib
+import json
+import logging
+import signal
+import time
+
+from utils import percentile
+
+logger = logging.getLogger('profile')
+
+
+class ProfiledAwaitable:
+    """Drive coroutine step by step and account cpu time of every step."""
+
+    def __init__(self, coro, key, profiler):
+        """Store coroutine and where to account its cpu time."""
+        self._coro = coro
+        self._key = key
+        self._profiler = profiler
+
+    def __await__(self):
+        """Run coroutine steps, passing yielded futures and thrown exceptions through."""
+        inner = self._coro.__await__()
+        value, error = None, None
+        while True:
+            started = time.thread_time()
+            try:
+                yielded = inner.throw(error) if error is not None else inner.send(value)
+            except StopIteration as ex:
+                return ex.value
+            finally:
+                self._profiler.account_step(self._key, time.thread_time() - started)
+
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                inner.close()
+                raise
+            except BaseException as ex:
+                value, error = None, ex
+
+
+def coroutine_key(coro):
+    """Make readable key of coroutine: module.qualname."""
+    name = getattr(coro, '__qualname__', type(coro).__name__)
+    frame = getattr(coro, 'cr_frame', None)
+    module = frame.f_globals.get('__name__') if frame is not None else None
+    return f'{module}.{name}' if module else name
+
+
+class SlowCallbackHandler(logging.Handler):
+    """Count slow callback warnings of asyncio debug mode."""
+
+    def __init__(self, profiler):
+        """Store profiler to account slow callbacks to."""
+        super().__init__(logging.WARNING)
+        self._profiler = profiler
+
+    def emit(self, record):
+        """Account 'Executing <handle> took N seconds' records."""
+        if isinstance(record.msg, str) and record.msg.startswith('Executing') and len(record.args or ()) == 2:
+            handle, duration = record.args
+            self._profiler.slow_callbacks[str(handle)[:200]] += 1
+            self._profiler.slow_callbacks_time += duration
+
+
+class Profiler:
+    """Measure event loop lag, report slow callbacks and cpu time of every task."""
+
+    def __init__(self, slow_callback_duration=0.1, lag_interval=0.1, report_path=None, max_samples=10000):
+        """Initiate profiler settings and empty stats."""
+        self.slow_callback_duration = slow_callback_duration
+        self.lag_interval = lag_interval
+        self.report_path = report_path
+        self.tasks = {}
+        self.lags = deque(maxlen=max_samples)
+        self.max_lag = 0.0
+        self.slow_callbacks = Counter()
+        self.slow_callbacks_time = 0.0
+        self._started = time.monotonic()
+        self._slow_callback_handler = SlowCallbackHandler(self)
+
+    def account_step(self, key, cpu_time):
+        """Account cpu time of one step of task key."""
+        stats = self.tasks.get(key)
+        if stats is None:
+            stats = self.tasks[key] = [0.0, 0, 0.0]
+        stats[0] += cpu_time
+        stats[1] += 1
+        if cpu_time > stats[2]:
+            stats[2] = cpu_time
+
+    def _task_factory(self, loop, coro, **kwargs):
+        return asyncio.Task(self._run(coro, coroutine_key(coro)), loop=loop, **kwargs)
+
+    async def _run(self, coro, key):
+        return await ProfiledAwaitable(coro, key, self)
+
+    def install(self, loop: asyncio.AbstractEventLoop):
+        """Enable slow callback reporting, wrap new tasks and dump report on SIGUSR1."""
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_callback_duration
+        logging.getLogger('asyncio').addHandler(self._slow_callback_handler)
+        loop.set_task_factory(self._task_factory)
+        with contextlib.suppress(NotImplementedError, AttributeError, RuntimeError):
+            loop.add_signal_handler(signal.SIGUSR1, self.dump)
+
+    def uninstall(self, loop: asyncio.AbstractEventLoop):
+        """Restore loop settings."""
+        loop.set_task_factory(None)
+        loop.set_debug(False)
+        logging.getLogger('asyncio').removeHandler(self._slow_callback_handler)
+        with contextlib.suppress(NotImplementedError, AttributeError, RuntimeError):
+            loop.remove_signal_handler(signal.SIGUSR1)
+
+    async def monitor_lag(self):
+        """Measure how late the loop wakes up after sleep of lag_interval."""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, time.monotonic() - started - self.lag_interval)
+            self.lags.append(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def report(self):
+        """Make report with loop lag percentiles, slow callbacks and tasks cpu time (seconds)."""
+        lags = sorted(self.lags)
+        tasks = sorted(self.tasks.items(), key=lambda item: item[1][0], reverse=True)
+        return {
+            'uptime': time.monotonic() - self._started,
+            'loop_lag': {
+                'p50': percentile(lags, 0.5),
+                'p99': percentile(lags, 0.99),
+                'max': self.max_lag,
+            },
+            'slow_callbacks': {
+                'count': sum(self.slow_callbacks.values()),
+                'time': self.slow_callbacks_time,
+                'top': self.slow_callbacks.most_common(10),
+            },
+            'tasks': {key: {'cpu': cpu, 'steps': steps, 'max_step': max_step}
+                      for key, (cpu, steps, max_step) in tasks},
+        }
+
+    def dump(self):
+        """Log report and write it to report_path if it is set."""
+        report = self.report()
+        logger.info('profile report: %s', json.dumps(report, ensure_ascii=False, indent=1))
+        if self.report_path:
+            with open(self.report_path, 'w', encoding='utf-8') as report_file:
+                json.dump(report, report_file, ensure_ascii=False, indent=1)
@@ -0,0 +1,174 @@
+"""Compact in-memory store of recent chat messages.
+
+All message texts are kept utf-8 encoded in one shared buffer, each one prefixed with newline,
+with array-backed offsets and times, so 100k+ messages cost a few megabytes.
+"""
+
+from array import array
+from bisect import bisect_right
+import datetime
+import itertools
+import re
+from typing import NamedTuple, Optional, Tuple
+
+from history import parse_text_timestamp
+
+DEFAULT_MAX_MESSAGES = 200_000
+UNKNOWN_TIME = -1
+
+
+class MessageFilter(NamedTuple):
+    """Filter of messages by keywords (all of them), nickname and time (unix seconds)."""
+
+    keywords: Tuple[str, ...] = ()
+    nickname: str = ''
+    since: Optional[int] = None
+
+    @property
+    def is_empty(self):
+        """Check if filter matches all messages."""
+        return not self.keywords and not self.nickname and self.since is None
+
+
+def parse_filter(query: str, since: str = '') -> MessageFilter:
+    """Make filter from search query and time string.
+
+    Query words starting with @ filter by nickname, message must contain all the other words.
+    Time is `HH:MM` (today) or `YYYY.MM.DD HH:MM`, invalid time is ignored.
+    """
+    nickname = ''
+    keywords = []
+    for word in query.split():
+        if word.startswith('@') and len(word) > 1:
+            nickname = word[1:]
+        else:
+            keywords.append(word)
+
+    since_time = None
+    since = since.strip()
+    if since:
+        if len(since) <= len('HH:MM'):
+            since = f'{datetime.date.today():%Y.%m.%d} {since}'
+        try:
+            since_time = parse_text_timestamp(since) // 1_000_000_000
+        except ValueError:
+            pass
+
+    return MessageFilter(tuple(keywords), nickname, since_time)
+
+
+def caseless_pattern(text: str) -> bytes:
+    """Make bytes regex matching utf-8 encoded text ignoring case (not only ascii)."""
+    parts = []
+    for char in text:
+        lower, upper = char.lower(), char.upper()
+        if lower == upper:
+            parts.append(re.escape(char.encode()))
+        else:
+            parts.append(b'(?:%s|%s)' % (re.escape(lower.encode()), re.escape(upper.encode())))
+    return b''.join(parts)
+
+
+class MessageStore:
+    """Recent messages in one shared buffer with array-backed offsets."""
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES):
+        """Initiate empty store keeping at most about max_messages."""
+        self.max_messages = max_messages
+        self._buffer = bytearray()
+        self._offsets = array('Q')
+        self._times = array('q')
+        self._stamped = array('b')
+
+    def __len__(self):
+        """Return number of stored messages."""
+        return len(self._offsets)
+
+    def append(self, text: str, wall_ns: Optional[int] = None, stamped=False):
+        """Append message, return its index.
+
+        Stamped messages are shown with their timestamp (lines loaded from history file).
+        """
+        self._offsets.append(len(self._buffer))
+        self._buffer += b'\n' + text.replace('\n', ' ').encode(errors='replace')
+        self._times.append(UNKNOWN_TIME if wall_ns is None else wall_ns // 1_000_000_000)
+        self._stamped.append(stamped)
+
+        if len(self._offsets) > self.max_messages * 3 // 2:
+            self._trim()
+        return len(self._offsets) - 1
+
+    def _trim(self):
+        """Drop oldest messages over max_messages.
+
+        Done in batches, so cost of moving the buffer is amortized over many appends.
+        """
+        drop = len(self._offsets) - self.max_messages
+        cut = self._offsets[drop]
+        del self._buffer[:cut]
+        self._offsets = array('Q', (offset - cut for offset in self._offsets[drop:]))
+        self._times = self._times[drop:]
+        self._stamped = self._stamped[drop:]
+
+    def get(self, index):
+        """Return (text, wall_ns, stamped) of message by index, wall_ns is None if unknown."""
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else len(self._buffer)
+        wall_time = self._times[index]
+        wall_ns = None if wall_time == UNKNOWN_TIME else wall_time * 1_000_000_000
+        return self._buffer[start + 1:end].decode(errors='replace'), wall_ns, bool(self._stamped[index])
+
+    def _patterns(self, message_filter: MessageFilter):
+        patterns = []
+        if message_filter.nickname:
+            # перевод строки перед каждым сообщением дает литеральный префикс, это в разы быстрее чем ^ и re.MULTILINE
+            patterns.append(re.compile(b'\n' + caseless_pattern(message_filter.nickname) + b':'))
+        # из слов первым идет самое длинное: оно встречается реже, и кандидатов для проверки остальных меньше
+        for keyword in sorted(message_filter.keywords, key=len, reverse=True):
+            patterns.append(re.compile(caseless_pattern(keyword)))
+        return patterns
+
+    def _first_since(self, since):
+        for index, wall_time in enumerate(self._times):
+            if wall_time >= since:
+                return index
+        return len(self._times)
+
+    def _matching_indexes(self, pattern, start):
+        indexes = []
+        for match in pattern.finditer(self._buffer, self._offsets[start] if start < len(self) else len(self._buffer)):
+            index = bisect_right(self._offsets, match.start()) - 1
+            if not indexes or indexes[-1] != index:
+                indexes.append(index)
+        return indexes
+
+    def search(self, message_filter: MessageFilter, limit=1000):
+        """Return indexes of matching messages.
+
+        If filter has since time, first limit matches since that time are returned, else last limit matches.
+        """
+        start = 0 if message_filter.since is None else self._first_since(message_filter.since)
+        patterns = self._patterns(message_filter)
+        if patterns:
+            indexes = self._matching_indexes(patterns[0], start)
+            if len(patterns) > 1:
+                indexes = [index for index in indexes if self._match_patterns(index, patterns[1:])]
+        else:
+            indexes = range(start, len(self))
+
+        if message_filter.since is not None:
+            # сообщения хранятся в порядке прихода, а не по времени: строки истории и живые могут чередоваться
+            since = message_filter.since
+            return list(itertools.islice((index for index in indexes if self._times[index] >= since), limit))
+        return list(indexes[-limit:])
+
+    def _match_patterns(self, index, patterns):
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else len(self._buffer)
+        return all(pattern.search(self._buffer, start, end) for pattern in patterns)
+
+    def matches(self, index, message_filter: MessageFilter):
+        """Check if message by index matches filter."""
+        if message_filter.since is not None and self._times[index] < message_filter.since:
+            return False
+        return self._match_patterns(index, self._patterns(message_filter))
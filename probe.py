@@ -0,0 +1,105 @@
+"""End-to-end delivery latency probe module.
+
+Probe messages are sent over writer connection and caught in the read stream.
+"""
+
+import asyncio
+from collections import deque
+import logging
+import re
+import time
+import uuid
+
+from history import ChatMessage
+from utils import percentile
+
+logger = logging.getLogger('probe')
+
+PROBE_PREFIX = '#latency-probe'
+PROBE_RE = re.compile(re.escape(PROBE_PREFIX) + r':(\w+):(\d+)')
+
+
+class LatencyProbe:
+    """Make tagged probe messages and measure time until they appear in the read stream."""
+
+    def __init__(self, loss_timeout=30, suppress=False, max_samples=10000):
+        """Initiate probe session."""
+        self.session = uuid.uuid4().hex[:12]
+        self.loss_timeout = loss_timeout
+        self.suppress = suppress
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self._sequence = 0
+        self._pending = {}
+        self._latencies = deque(maxlen=max_samples)
+
+    def make_message(self):
+        """Make next probe message and remember its send time."""
+        self._sequence += 1
+        message = f'{PROBE_PREFIX}:{self.session}:{self._sequence}'
+        self._pending[message] = time.monotonic_ns()
+        self.sent += 1
+        return message
+
+    def mark_sent(self, message):
+        """Update send time of probe message when it is actually written to connection."""
+        if message in self._pending:
+            self._pending[message] = time.monotonic_ns()
+
+    def observe(self, message: ChatMessage):
+        """Account message from the read stream, return True if it is a probe message."""
+        match = PROBE_RE.search(message.text)
+        if not match:
+            return False
+
+        sent_ns = self._pending.pop(match.group(0), None)
+        if sent_ns is not None:
+            received_ns = message.monotonic_ns or time.monotonic_ns()
+            self._latencies.append((received_ns - sent_ns) / 1e9)
+            self.received += 1
+        return True
+
+    def expire(self):
+        """Count probes not received within loss_timeout as lost."""
+        deadline = time.monotonic_ns() - int(self.loss_timeout * 1e9)
+        for message, sent_ns in list(self._pending.items()):
+            if sent_ns < deadline:
+                del self._pending[message]
+                self.lost += 1
+
+    def report(self):
+        """Make report with latency percentiles (seconds) and loss."""
+        latencies = sorted(self._latencies)
+        finished = self.received + self.lost
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'lost': self.lost,
+            'in_flight': len(self._pending),
+            'loss': self.lost / finished if finished else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        }
+
+
+def log_report(probe: LatencyProbe):
+    """Log probe report."""
+    logger.info('latency probe: %s', probe.report())
+
+
+async def run_probe(probe: LatencyProbe, sending_queue: asyncio.Queue, interval: float, report_interval=60):
+    """Put probe message to sending_queue every interval seconds and log report every report_interval."""
+    last_report = time.monotonic()
+    try:
+        while True:
+            sending_queue.put_nowait(probe.make_message())
+            await asyncio.sleep(interval)
+            probe.expire()
+            if time.monotonic() - last_report >= report_interval:
+                last_report = time.monotonic()
+                log_report(probe)
+    finally:
+        log_report(probe)
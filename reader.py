@@ -2,42 +2,57 @@
 
 import asyncio
 from asyncio.exceptions import TimeoutError
-import datetime
 import logging
+import uuid
 
-import aiofiles
 from async_timeout import timeout
 import configargparse
 
+from capture import capture_connection
+from capture import CaptureWriter
 from consts import CONNECT_TIMEOUT
+from consts import MAX_LINE_LENGTH
 from consts import READ_TIMEOUT
+from framing import LineFramer
+from framing import OVERSIZED_MODES
+from history import ChatMessage
+from history import format_message
+from history import HISTORY_FORMATS
+from history import HistoryWriter
+from history import make_timestamp  # noqa: F401 (kept for backward compatibility)
 from utils import Backoff
+from utils import interrupt_on_sigterm
 from utils import open_connection
 
 logger = logging.getLogger('reader')
 
 
-def make_timestamp():
-    """Make formatted current time string."""
-    return datetime.datetime.now().strftime("%Y.%m.%d %H:%M")
-
-
 @Backoff.async_retry(exception=TimeoutError, max_wait=60, jitter=1, logger=logger,
                      min_time_for_reset=max(CONNECT_TIMEOUT, READ_TIMEOUT) + 1)
-async def connect_and_read(host, port, history_file):
-    """Connect to chat server, read and save all messages to history_file."""
-    async with open_connection(host, port) as (reader, _):
-
-        async with aiofiles.open(history_file, mode='a') as chat_log_file:
+async def connect_and_read(host, port, history_file, history_format='text', capture=None, framer=None):
+    """Connect to chat server, read and save all messages to history_file in history_format.
+
+    Raw stream is recorded to capture (CaptureWriter) as it arrives, if capture is given.
+    Lines are framed and decoded by framer (LineFramer), so bad lines do not break connection.
+    """
+    server = f'{host}:{port}'
+    if framer is None:
+        framer = LineFramer()
+    read_connection = capture_connection(capture) if capture is not None else asyncio.open_connection
+    async with open_connection(host, port, limit=framer.max_line_length,
+                               open_connection=read_connection) as (reader, _):
+        connection_id = uuid.uuid4().hex
+
+        with HistoryWriter(history_file) as history_writer:
             while not reader.at_eof():
                 async with timeout(READ_TIMEOUT):
-                    line = await reader.readline()
+                    line = await framer.readline(reader)
 
-                formatted_line = f'[{make_timestamp()}] {line.decode()}'
+                message = ChatMessage.received(framer.decode(line).rstrip(), server, connection_id)
+                formatted_line = format_message(message, history_format)
                 logger.debug(repr(formatted_line))
 
-                await chat_log_file.write(formatted_line)
-                await chat_log_file.flush()
+                await history_writer.write([formatted_line])
 
 
 def main():
@@ -50,18 +65,32 @@ def main():
     args.add('-c', '--config', is_config_file=True, help='config file path')
     args.add('--read_host', env_var='READ_HOST', help='host of server to read')
     args.add('--read_port', env_var='READ_PORT', help='port of server to read')
+    args.add('--max_line_length', type=int, default=MAX_LINE_LENGTH, env_var='MAX_LINE_LENGTH',
+             help='max length of chat line in bytes')
+    args.add('--oversized_lines', choices=OVERSIZED_MODES, default='truncate', env_var='OVERSIZED_LINES',
+             help='truncate oversized lines or deliver them in chunks')
+    args.add('--capture', env_var='CAPTURE_FILE', help='record raw read stream to capture file')
     args.add('--loglevel', help='log level')
     args.add('--history', env_var='HISTORY_FILE', help='history file path')
+    args.add('--history_format', env_var='HISTORY_FORMAT', choices=HISTORY_FORMATS, default='text',
+             help='history file format')
     options = args.parse_args()
 
     if options.loglevel:
         logging.basicConfig(level=options.loglevel)
         logger.setLevel(options.loglevel)
 
+    capture = CaptureWriter(options.capture) if options.capture else None
+    framer = LineFramer(options.max_line_length, options.oversized_lines)
+    interrupt_on_sigterm()
     try:
-        asyncio.run(connect_and_read(options.read_host, options.read_port, options.history))
+        asyncio.run(connect_and_read(options.read_host, options.read_port,
+                                     options.history, options.history_format, capture, framer))
     except KeyboardInterrupt:
         logger.debug('Reader stopped')
+    finally:
+        if capture is not None:
+            capture.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,226 @@
+"""Local relay sharing one upstream chat connection between many local clients.
+
+Local readers get the same line stream as from the chat read server,
+local writers talk the same protocol as with the chat write server,
+so existing clients only need host and port of the relay.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+
+import anyio
+import configargparse
+
+from app import handle_connection
+from app import read_msgs
+from app import save_messages
+from app import send_msgs
+from app import watch_for_connection
+from consts import MAX_LINE_LENGTH
+import events
+from framing import LineFramer
+from framing import OVERSIZED_MODES
+from history import HISTORY_FORMATS
+
+logger = logging.getLogger('relay')
+
+HELLO_MESSAGE = b'Hello %username%! Enter your personal hash or leave it empty to create new account.\n'
+WELCOME_MESSAGE = b'Welcome to chat! Post your message below. End it with an empty line.\n'
+CONFIRM_MESSAGE = b'Message send. Write more, end message with an empty line.\n'
+WRONG_TOKEN_MESSAGE = b'null\n'
+
+
+class Relay:
+    """Local clients of relay and shared upstream state."""
+
+    def __init__(self, token=None, client_queue_size=1000):
+        """Initiate empty relay."""
+        self.token = token
+        self.nickname = None
+        self.client_queue_size = client_queue_size
+        self.sending_queue = asyncio.Queue()
+        self._clients = set()
+
+    def broadcast(self, data: bytes):
+        """Put data to queues of all local readers, drop readers which do not keep up."""
+        for queue in list(self._clients):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                logger.warning('drop slow local reader')
+                self._clients.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def serve_reader(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Stream chat lines to local reader until it disconnects or falls behind."""
+        queue = asyncio.Queue(self.client_queue_size)
+        self._clients.add(queue)
+        logger.debug('local reader connected, %d readers', len(self._clients))
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    return
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(queue)
+            writer.close()
+
+    async def serve_writer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Talk chat write protocol with local writer and forward its messages upstream.
+
+        Message is confirmed once per terminator: empty line after message text or two empty lines (ping).
+        Confirmation is sent as soon as message is queued for upstream, i.e. before upstream server confirms it.
+        """
+        try:
+            writer.write(HELLO_MESSAGE)
+            await writer.drain()
+
+            token = (await reader.readline()).decode(errors='replace').strip()
+            if not self.token or token != self.token:
+                writer.write(WRONG_TOKEN_MESSAGE)
+                await writer.drain()
+                return
+
+            login_response = {'nickname': self.nickname, 'account_hash': self.token}
+            writer.write(json.dumps(login_response).encode() + b'\n' + WELCOME_MESSAGE)
+            await writer.drain()
+
+            lines = []
+            ping_started = False
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                text = line.decode(errors='replace').rstrip('\r\n')
+                if text:
+                    lines.append(text)
+                    ping_started = False
+                    continue
+
+                if lines:
+                    self.sending_queue.put_nowait('\n'.join(lines))
+                    lines = []
+                elif ping_started:
+                    # пинг - это две пустые строки подряд, он подтвержден на первой из них
+                    ping_started = False
+                    continue
+                else:
+                    ping_started = True
+                writer.write(CONFIRM_MESSAGE)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def broadcast_messages(relay: Relay, queue: asyncio.Queue):
+    """Send messages read from upstream to all local readers."""
+    while True:
+        message = await queue.get()
+        relay.broadcast(f'{message.text}\n'.encode())
+
+
+async def track_status_updates(relay: Relay, status_updates_queue: asyncio.Queue):
+    """Log upstream connection statuses and remember nickname for local writers."""
+    while True:
+        status = await status_updates_queue.get()
+        if isinstance(status, events.NicknameReceived):
+            relay.nickname = status.nickname
+            logger.info('upstream writer authorized as %r', status.nickname)
+        else:
+            logger.info('%s: %s', type(status).__name__, status)
+
+
+async def serve(handler, host=None, port=None, socket_path=None):
+    """Serve local clients with handler on tcp host:port or unix socket_path."""
+    if socket_path:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(handler, socket_path)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def main(options):
+    """Connect upstream and serve local readers and writers."""
+    relay = Relay(options.write_token, options.client_queue_size)
+    broadcast_queue = asyncio.Queue()
+    messages_log_queue = asyncio.Queue()
+    status_updates_queue = asyncio.Queue()
+    watchdog_queue = asyncio.Queue()
+    framer = LineFramer(options.max_line_length, options.oversized_lines)
+
+    out_queues = [broadcast_queue]
+    upstream = [
+        lambda: read_msgs(options.read_host, options.read_port, status_updates_queue, watchdog_queue,
+                          *out_queues, framer=framer),
+        lambda: watch_for_connection(watchdog_queue),
+    ]
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(track_status_updates, relay, status_updates_queue)
+        tg.start_soon(broadcast_messages, relay, broadcast_queue)
+        tg.start_soon(serve, relay.serve_reader, options.relay_host, options.relay_read_port,
+                      options.relay_read_socket)
+
+        if options.history:
+            out_queues.append(messages_log_queue)
+            tg.start_soon(save_messages, options.history, messages_log_queue, options.history_format)
+
+        if options.write_token:
+            upstream.append(lambda: send_msgs(options.write_host, options.write_port, options.write_token,
+                                              relay.sending_queue, status_updates_queue, watchdog_queue))
+            tg.start_soon(serve, relay.serve_writer, options.relay_host, options.relay_write_port,
+                          options.relay_write_socket)
+
+        tg.start_soon(handle_connection, *upstream)
+
+
+if __name__ == '__main__':
+    args = configargparse.ArgParser(
+        prog='relay.py',
+        ignore_unknown_config_file_keys=True,
+        default_config_files=['.settings', '.token']
+    )
+    args.add('-c', '--config', is_config_file=True, help='config file path')
+    args.add('--read_host', env_var='READ_HOST', help='host of server to read')
+    args.add('--read_port', env_var='READ_PORT', help='port of server to read')
+    args.add('--write_host', env_var='WRITE_HOST', help='host of server to write')
+    args.add('--write_port', env_var='WRITE_PORT', help='port of server to write')
+    args.add('--write_token', env_var='TOKEN', help='token of upstream writer (local writers are disabled if empty)')
+    args.add('--relay_host', env_var='RELAY_HOST', default='127.0.0.1', help='host to serve local clients on')
+    args.add('--relay_read_port', env_var='RELAY_READ_PORT', type=int, default=5000,
+             help='port to serve local readers on')
+    args.add('--relay_write_port', env_var='RELAY_WRITE_PORT', type=int, default=5050,
+             help='port to serve local writers on')
+    args.add('--relay_read_socket', env_var='RELAY_READ_SOCKET', help='unix socket to serve local readers on')
+    args.add('--relay_write_socket', env_var='RELAY_WRITE_SOCKET', help='unix socket to serve local writers on')
+    args.add('--client_queue_size', type=int, default=1000,
+             help='lines buffered for slow local reader before it is disconnected')
+    args.add('--max_line_length', type=int, default=MAX_LINE_LENGTH, env_var='MAX_LINE_LENGTH',
+             help='max length of chat line in bytes')
+    args.add('--oversized_lines', choices=OVERSIZED_MODES, default='truncate', env_var='OVERSIZED_LINES',
+             help='truncate oversized lines or deliver them in chunks')
+    args.add('--history', env_var='HISTORY_FILE', help='history file path (history is not saved if empty)')
+    args.add('--history_format', env_var='HISTORY_FORMAT', choices=HISTORY_FORMATS, default='text',
+             help='history file format')
+    args.add('--loglevel', help='log level')
+    options = args.parse_args()
+
+    logging.basicConfig(level=options.loglevel or logging.INFO)
+    logger.setLevel(options.loglevel or logging.INFO)
+
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(main(options))
@@ -0,0 +1,60 @@
+"""Replay captured chat stream through read and save pipeline without network."""
+
+import asyncio
+import logging
+import sys
+import time
+
+import anyio
+import configargparse
+
+from app import replay_msgs
+from app import save_messages
+from app import wait_queue_empty
+from capture import CaptureError
+from history import HISTORY_FORMATS
+
+logger = logging.getLogger('replay')
+
+
+async def replay(capture_path, history_file, history_format='text', speed=0.0):
+    """Feed capture to read_msgs and save_messages, return (messages count, elapsed seconds)."""
+    status_updates_queue = asyncio.Queue()
+    messages_log_queue = asyncio.Queue()
+
+    start = time.monotonic()
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(save_messages, history_file, messages_log_queue, history_format)
+        messages = await replay_msgs(capture_path, speed, status_updates_queue, messages_log_queue)
+        await wait_queue_empty(messages_log_queue)
+        tg.cancel_scope.cancel()
+
+    return messages, time.monotonic() - start
+
+
+def main():
+    """Parse args, replay capture and log throughput."""
+    args = configargparse.ArgParser(prog='replay.py')
+    args.add('-c', '--config', is_config_file=True, help='config file path')
+    args.add('--history', default='replay.log', help='history file path to save replayed messages')
+    args.add('--history_format', choices=HISTORY_FORMATS, default='text', help='history file format')
+    args.add('--speed', type=float, default=0.0, help='replay speed multiplier, 0 - as fast as possible')
+    args.add('--loglevel', default='INFO', help='log level')
+    args.add('capture', help='capture file recorded with --capture')
+    options = args.parse_args()
+
+    logging.basicConfig(level=options.loglevel)
+    logger.setLevel(options.loglevel)
+
+    try:
+        messages, elapsed = asyncio.run(replay(options.capture, options.history, options.history_format,
+                                               options.speed))
+    except CaptureError as ex:
+        logger.error('%s', ex)
+        sys.exit(1)
+    logger.info('replayed %d messages in %.3f s (%.0f messages/s)', messages, elapsed,
+                messages / elapsed if elapsed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,18 @@
 
 import asyncio
 from contextlib import asynccontextmanager
+import functools
 import logging
+import math
 import random
+import signal
 import time
 from typing import Optional, Tuple, Union
 
 from async_timeout import timeout
 
 from consts import CONNECT_TIMEOUT
+from consts import MAX_LINE_LENGTH
 
 
 class Backoff:
@@ -60,6 +64,7 @@ class Backoff:
                     base=2, factor=1, max_wait=None, jitter=None, min_time_for_reset=None, logger=None):
         """Make decorator to retry with backoff."""
         def wrapper(func):
+            @functools.wraps(func)
             async def wrapped(*args, **kwargs):
                 backoff_waiter = cls(base=base,
                                      factor=factor,
@@ -98,15 +103,21 @@ async def open_connection(
         connect_timeout=CONNECT_TIMEOUT,
         on_connecting=None,
         on_connected=None,
-        on_closed=None) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
-    """Make connection and close it after __aexit__."""
+        on_closed=None,
+        limit=MAX_LINE_LENGTH,
+        open_connection=asyncio.open_connection) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Make connection and close it after __aexit__.
+
+    limit is a StreamReader buffer limit (and max line length).
+    open_connection can be replaced, e.g. with capture.capture_connection.
+    """
     call_if_callable(on_connecting)
 
     writer: Optional[asyncio.StreamWriter] = None
     try:
         async with timeout(connect_timeout):
             reader: asyncio.StreamReader
-            reader, writer = await asyncio.open_connection(host, port)
+            reader, writer = await open_connection(host, port, limit=limit)
 
         call_if_callable(on_connected)
 
@@ -125,3 +136,19 @@ class ProtocolError(Exception):
 
 class WrongToken(ProtocolError):
     """Exception for protocol problems with token."""
+
+
+def percentile(sorted_values, fraction):
+    """Return nearest-rank percentile of already sorted values (fraction in 0..1)."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def interrupt_on_sigterm():
+    """Raise KeyboardInterrupt on SIGTERM (e.g. docker stop), so it stops as on Ctrl+C with finally blocks run."""
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, interrupt)